@@ -7,6 +7,25 @@ os.makedirs(DB_DIR, exist_ok=True)
 # Database path
 DB_PATH = os.path.join(DB_DIR, 'faces.sqlite')
 
+# Face image storage
+FACE_IMAGES_DIR = os.path.join(DB_DIR, 'face_images')
+os.makedirs(FACE_IMAGES_DIR, exist_ok=True)
+STORE_FACE_IMAGES_AS_FILES = True  # Store face images as JPEG files and keep only their path in the database
+FACE_IMAGE_QUALITY = 95  # JPEG quality for stored face images
+BATCH_ENCODE_WORKERS = 4  # Threads encoding face images in parallel for batch saves
+
+# Memory-mapped embedding cache (rebuilt when the database changes)
+USE_EMBEDDING_CACHE = True  # Load embeddings from the memory-mapped cache when it is current
+EMBEDDING_CACHE_PATH = os.path.join(DB_DIR, 'faces_embeddings.f32')
+EMBEDDING_INDEX_PATH = os.path.join(DB_DIR, 'faces_index.npz')
+
+# Database tuning
+DB_RELAXED_SYNC = True  # synchronous=NORMAL in WAL mode (last commits may be lost on power failure)
+DB_CACHE_SIZE_KB = 65536  # SQLite page cache size (KiB)
+DB_MMAP_SIZE = 268435456  # Memory-mapped I/O size (bytes)
+DB_WAL_AUTOCHECKPOINT = 1000  # WAL pages before automatic checkpoint
+WRITE_QUEUE_BATCH_SIZE = 50  # Maximum queued writes committed per transaction
+
 # Configuration
 MIN_FACE_SIZE = 60  # Minimum size of face to consider
 TRACKING_THRESHOLD = 0.5  # IOU threshold for tracking
@@ -36,6 +55,7 @@ ERROR_DISPLAY_DURATION = 1500  # Duration to display error messages (ms)
 
 # Feature extraction parameters
 MAX_EMBEDDINGS_PER_PERSON = 30  # Maximum embeddings stored per person
+MIN_QUALITY_KEEP = 0.0  # Minimum quality score for an embedding to be stored or loaded (0 keeps all)
 GLOBAL_HIST_BINS = 32  # Number of bins for global histogram
 REGIONAL_HIST_BINS = 16  # Number of bins for regional histograms
 EDGE_HIST_BINS = 32  # Number of bins for edge histogram
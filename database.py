@@ -1,67 +1,208 @@
+import os
+import queue
 import sqlite3
-import pickle
-from datetime import datetime
+import threading
+import uuid
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
 import cv2
 import numpy as np
-from config import DB_PATH, DEBUG_MODE, MAX_EMBEDDINGS_PER_PERSON
+from config import (
+    DB_PATH, DEBUG_MODE, MAX_EMBEDDINGS_PER_PERSON, DB_RELAXED_SYNC,
+    DB_CACHE_SIZE_KB, DB_MMAP_SIZE, DB_WAL_AUTOCHECKPOINT, DB_DIR,
+    FACE_IMAGES_DIR, STORE_FACE_IMAGES_AS_FILES, FACE_IMAGE_QUALITY,
+    WRITE_QUEUE_BATCH_SIZE, USE_EMBEDDING_CACHE,
+    EMBEDDING_CACHE_PATH, EMBEDDING_INDEX_PATH, MIN_QUALITY_KEEP, BATCH_ENCODE_WORKERS
+)
+
+# libjpeg-turbo encoder (optional, falls back to OpenCV)
+try:
+    from turbojpeg import TurboJPEG
+    _turbo_jpeg = TurboJPEG()
+except Exception:
+    _turbo_jpeg = None
+
+# APSW (optional) talks to the SQLite C API more directly than sqlite3; when
+# installed it serves the per-frame active person queries and embedding reads.
+# Builds bundling their own SQLite are skipped: two SQLite copies in one process
+# release each other's POSIX locks on the same database file.
+try:
+    import apsw
+    if apsw.using_amalgamation:
+        apsw = None
+except ImportError:
+    apsw = None
+
+# Statements used on hot paths; kept as constants so every call reuses the
+# connection's prepared statement cache
+_SQL_SELECT_FACE_ID = "SELECT id FROM faces WHERE name = ?"
+# timestamp is filled by SQLite (also for databases created before the column default).
+# Names are unique: an existing name inserts nothing and returns no row
+_SQL_INSERT_FACE = """
+    INSERT INTO faces (name, image, timestamp) VALUES (?, ?, CURRENT_TIMESTAMP)
+    ON CONFLICT(name) DO NOTHING
+    RETURNING id
+"""
+_SQL_INSERT_FACE_WITH_FEATURES = """
+    INSERT INTO faces (name, image, features, timestamp) VALUES (?, ?, ?, CURRENT_TIMESTAMP)
+    ON CONFLICT(name) DO NOTHING
+"""
+_SQL_SELECT_FACE_EMBEDDINGS = "SELECT embeddings, qualities, dim, embedding_count FROM faces WHERE id = ?"
+_SQL_UPDATE_EMBEDDINGS = """
+    UPDATE faces SET embeddings = ?, qualities = ?, dim = ?, embedding_count = ?
+    WHERE id = ?
+"""
+_SQL_COUNT_LOADED_EMBEDDINGS = "SELECT COALESCE(SUM(MIN(embedding_count, ?)), 0) FROM faces"
+_SQL_EMBEDDING_FINGERPRINT = """
+    SELECT (SELECT instance_id FROM db_meta WHERE id = 1),
+           COUNT(*), COALESCE(MAX(id), 0), COALESCE(SUM(embedding_count), 0)
+    FROM faces
+"""
+# Rows are stored best-first, so substr() crops each face to its best
+# :max_k embeddings before the bytes reach Python
+_SQL_LOAD_EMBEDDINGS = """
+    SELECT id, name,
+           substr(embeddings, 1, 4 * dim * MIN(embedding_count, :max_k)),
+           substr(qualities, 1, 4 * MIN(embedding_count, :max_k)),
+           dim
+    FROM faces
+    WHERE embedding_count > 0
+    ORDER BY id
+"""
+# Same rows without the embeddings BLOB, which APSW reads separately
+_SQL_LOAD_EMBEDDING_META = """
+    SELECT id, name, NULL, substr(qualities, 1, 4 * MIN(embedding_count, :max_k)), dim
+    FROM faces
+    WHERE embedding_count > 0
+    ORDER BY id
+"""
+_SQL_UPDATE_ACTIVE = """
+    UPDATE active_person 
+    SET person_id = ?, last_seen = CURRENT_TIMESTAMP 
+    WHERE id = 1
+"""
+_SQL_GET_ACTIVE = """
+    SELECT f.id, f.name, a.last_seen 
+    FROM active_person a 
+    LEFT JOIN faces f ON a.person_id = f.id 
+    WHERE a.id = 1
+"""
+
+# APSW connection opened by init_database when apsw is installed
+_apsw_conn = None
+
+# Single writer thread started by init_database; every write goes through it
+_writer = None
+
+# Guards the embedding cache files shared by reader threads
+_cache_lock = threading.Lock()
+
+def _connect():
+    """Open a tuned connection to DB_PATH"""
+    # Autocommit mode: transactions are opened explicitly with BEGIN
+    conn = sqlite3.connect(DB_PATH, isolation_level=None, cached_statements=256,
+                           check_same_thread=False)
+    
+    # Enable WAL mode so readers never block the writer
+    conn.execute("PRAGMA journal_mode=WAL")
+    
+    # Reduce fsyncs and disk traffic per commit
+    if DB_RELAXED_SYNC:
+        conn.execute("PRAGMA synchronous=NORMAL")
+    conn.execute("PRAGMA temp_store=MEMORY")
+    conn.execute(f"PRAGMA mmap_size={int(DB_MMAP_SIZE)}")
+    conn.execute(f"PRAGMA cache_size={-int(DB_CACHE_SIZE_KB)}")
+    conn.execute(f"PRAGMA wal_autocheckpoint={int(DB_WAL_AUTOCHECKPOINT)}")
+    return conn
 
 def init_database():
-    """Initialize the database and return connection and cursor"""
+    """Initialize the database and return connection and cursor
+    
+    The returned connection is the calling thread's read-only connection;
+    writes go through the database writer thread.
+    """
+    global _apsw_conn, _writer
     try:
-        conn = sqlite3.connect(DB_PATH)
+        # Let a previous writer commit its queue and close its connection
+        if _writer is not None:
+            _writer.stop()
+            _writer = None
+        
+        conn = _connect()
         cursor = conn.cursor()
         
-        # Enable WAL mode for better concurrent access
-        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("BEGIN IMMEDIATE")
         
         # Create faces table (main table for person info)
+        # embeddings holds the face's (embedding_count, dim) float32 matrix and
+        # qualities the matching float32 vector, both ordered by quality descending
         cursor.execute('''
         CREATE TABLE IF NOT EXISTS faces (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             name TEXT NOT NULL,
             image BLOB,
             features BLOB,
-            timestamp TEXT
+            embeddings BLOB,
+            qualities BLOB,
+            dim INTEGER,
+            embedding_count INTEGER NOT NULL DEFAULT 0,
+            timestamp TEXT DEFAULT CURRENT_TIMESTAMP
         )
         ''')
         
-        # Create face_embeddings table (stores averaged embeddings per face)
-        cursor.execute('''
-        CREATE TABLE IF NOT EXISTS face_embeddings (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            face_id INTEGER NOT NULL,
-            features BLOB NOT NULL,
-            quality_score FLOAT NOT NULL,
-            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-            FOREIGN KEY (face_id) REFERENCES faces(id)
-        )
-        ''')
+        # Older databases keep one row per embedding in face_embeddings
+        _ensure_column(cursor, 'faces', 'embeddings', 'BLOB')
+        _ensure_column(cursor, 'faces', 'qualities', 'BLOB')
+        _ensure_column(cursor, 'faces', 'dim', 'INTEGER')
+        _ensure_column(cursor, 'faces', 'embedding_count', 'INTEGER NOT NULL DEFAULT 0')
+        _migrate_face_embeddings(cursor)
         
-        # Create active_person table (stores currently active person)
+        # Create active_person table (single row pinned at id=1, stores currently active person)
         cursor.execute('''
         CREATE TABLE IF NOT EXISTS active_person (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            id INTEGER PRIMARY KEY CHECK (id = 1),
             person_id INTEGER,
             last_seen TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             FOREIGN KEY (person_id) REFERENCES faces(id)
         )
         ''')
         
-        # Ensure only one row exists in active_person table
-        cursor.execute("SELECT COUNT(*) FROM active_person")
-        count = cursor.fetchone()[0]
-        if count == 0:
-            cursor.execute("INSERT INTO active_person (person_id) VALUES (NULL)")
-        elif count > 1:
-            cursor.execute("DELETE FROM active_person")
-            cursor.execute("INSERT INTO active_person (person_id) VALUES (NULL)")
+        # Ensure the single row exists (older databases may hold other ids)
+        cursor.execute("DELETE FROM active_person WHERE id != 1")
+        cursor.execute("INSERT OR IGNORE INTO active_person (id, person_id) VALUES (1, NULL)")
+        
+        # Create db_meta table (single row with a random id stamped when the database is created)
+        cursor.execute('''
+        CREATE TABLE IF NOT EXISTS db_meta (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            instance_id INTEGER NOT NULL
+        )
+        ''')
+        # 48 bits, so the id survives the float64 cache fingerprint exactly
+        cursor.execute("INSERT OR IGNORE INTO db_meta (id, instance_id) VALUES (1, ?)",
+                       (uuid.uuid4().int >> 80,))
         
-        # Create indices for better query performance
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_face_id ON face_embeddings(face_id)')
-        cursor.execute('CREATE INDEX IF NOT EXISTS idx_faces_name ON faces(name)')
+        # Names are unique; older databases may hold duplicates to merge first
+        cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'index' AND name = 'idx_faces_name_uniq'")
+        if cursor.fetchone() is None:
+            _merge_duplicate_faces(cursor)
+            cursor.execute('CREATE UNIQUE INDEX idx_faces_name_uniq ON faces(name)')
+            cursor.execute('DROP INDEX IF EXISTS idx_faces_name')
         
         conn.commit()
         
+        # From here on this connection only reads
+        cursor.execute("PRAGMA query_only=1")
+        _writer = _DatabaseWriter()
+        
+        if apsw is not None:
+            if _apsw_conn is not None:
+                _apsw_conn.close()
+            _apsw_conn = apsw.Connection(DB_PATH)
+            _apsw_conn.setbusytimeout(5000)
+            # Reads only; every write goes through the writer thread
+            _apsw_conn.execute("PRAGMA query_only=1")
+        
         # Get face count
         cursor.execute("SELECT COUNT(*) FROM faces")
         face_count = cursor.fetchone()[0]
@@ -73,21 +214,200 @@ def init_database():
         print(f"Database error: {e}")
         return None, None
 
-def _prepare_face_data(face_img, features=None):
-    """Helper function to prepare face data for database storage"""
-    # Convert image to bytes
-    _, img_encoded = cv2.imencode('.jpg', face_img)
-    img_bytes = img_encoded.tobytes()
+def _ensure_column(cursor, table, column, declaration):
+    """Add a column to an existing table if it is missing"""
+    cursor.execute(f"PRAGMA table_info({table})")
+    if column not in (row[1] for row in cursor.fetchall()):
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {declaration}")
+
+def _migrate_face_embeddings(cursor):
+    """Fold rows of the old face_embeddings table into faces.embeddings"""
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'face_embeddings'")
+    if cursor.fetchone() is None:
+        return
+    
+    cursor.execute("PRAGMA table_info(face_embeddings)")
+    has_dim = 'dim' in (row[1] for row in cursor.fetchall())
+    cursor.execute(f'''
+        SELECT face_id, features, {'dim' if has_dim else 'NULL'}, quality_score
+        FROM face_embeddings
+        ORDER BY face_id, quality_score DESC
+    ''')
+    
+    face_rows = {}
+    for face_id, feat_blob, dim, quality in cursor.fetchall():
+        # Rows without dim are legacy float64 embeddings
+        embedding = np.frombuffer(feat_blob, dtype=np.float64 if dim is None else np.float32)
+        rows = face_rows.setdefault(face_id, ([], []))
+        if len(rows[0]) < MAX_EMBEDDINGS_PER_PERSON:
+            rows[0].append(embedding)
+            rows[1].append(quality)
+    
+    updates = []
+    for face_id, (face_embeddings, face_qualities) in face_rows.items():
+        embeddings = np.asarray(face_embeddings, dtype=np.float32)
+        qualities = np.asarray(face_qualities, dtype=np.float32)
+        updates.append((_as_blob(embeddings), _as_blob(qualities), embeddings.shape[1], len(qualities), face_id))
+    cursor.executemany(_SQL_UPDATE_EMBEDDINGS, updates)
+    cursor.execute("DROP TABLE face_embeddings")
+    
+    if DEBUG_MODE:
+        print(f"Migrated embeddings of {len(updates)} faces from face_embeddings")
+
+def _merge_duplicate_faces(cursor):
+    """Fold faces sharing a name into the oldest one, keeping their best embeddings"""
+    cursor.execute("SELECT name, MIN(id) FROM faces GROUP BY name HAVING COUNT(*) > 1")
+    for name, keep_id in cursor.fetchall():
+        cursor.execute("SELECT id FROM faces WHERE name = ? AND id != ? ORDER BY id", (name, keep_id))
+        duplicate_ids = [row[0] for row in cursor.fetchall()]
+        
+        stored = [_read_face_embeddings(cursor, face_id) for face_id in [keep_id, *duplicate_ids]]
+        stored = [(embeddings, qualities) for embeddings, qualities in stored if qualities is not None]
+        if stored:
+            dim = stored[0][0].shape[1]
+            stored = [(embeddings, qualities) for embeddings, qualities in stored if embeddings.shape[1] == dim]
+            embeddings = np.concatenate([embeddings for embeddings, _ in stored])
+            qualities = np.concatenate([qualities for _, qualities in stored])
+            order = np.argsort(-qualities, kind='stable')[:MAX_EMBEDDINGS_PER_PERSON]
+            embeddings = np.ascontiguousarray(embeddings[order])
+            qualities = np.ascontiguousarray(qualities[order])
+            cursor.execute(_SQL_UPDATE_EMBEDDINGS, (_as_blob(embeddings), _as_blob(qualities), dim, len(qualities), keep_id))
+        
+        placeholders = ', '.join('?' * len(duplicate_ids))
+        cursor.execute(f"UPDATE active_person SET person_id = ? WHERE person_id IN ({placeholders})",
+                       (keep_id, *duplicate_ids))
+        cursor.execute(f"DELETE FROM faces WHERE id IN ({placeholders})", duplicate_ids)
+        
+        if DEBUG_MODE:
+            print(f"Merged {len(duplicate_ids)} duplicate faces into '{name}' (ID: {keep_id})")
+
+def _as_float32(features):
+    """Return features as a contiguous float32 vector for storage"""
+    return np.ascontiguousarray(features, dtype=np.float32).ravel()
+
+def _as_blob(array):
+    """Wrap a contiguous array as a BLOB parameter without copying it to bytes"""
+    return sqlite3.Binary(memoryview(array).cast('B'))
+
+def _read_face_embeddings(cursor, face_id):
+    """Return a face's stored (embeddings, qualities), or (None, None) if it has none"""
+    cursor.execute(_SQL_SELECT_FACE_EMBEDDINGS, (face_id,))
+    feat_blob, quality_blob, dim, count = cursor.fetchone()
+    if count == 0:
+        return None, None
+    embeddings = np.frombuffer(feat_blob, dtype=np.float32).reshape(count, dim)
+    return embeddings, np.frombuffer(quality_blob, dtype=np.float32)
+
+def _append_embedding(embeddings, qualities, embedding, quality_score):
+    """Add an embedding to a face's matrix, keeping rows ordered by quality descending"""
+    if embeddings is None:
+        return embedding[np.newaxis], np.array([quality_score], dtype=np.float32)
+    
+    embeddings = np.concatenate([embeddings, embedding[np.newaxis]])
+    qualities = np.append(qualities, np.float32(quality_score))
+    order = np.argsort(-qualities, kind='stable')
+    return embeddings[order], qualities[order]
+
+def _encode_jpeg(face_img):
+    """Encode a face image as JPEG bytes"""
+    if _turbo_jpeg is not None:
+        return _turbo_jpeg.encode(face_img, quality=FACE_IMAGE_QUALITY)
+    _, img_encoded = cv2.imencode('.jpg', face_img, [cv2.IMWRITE_JPEG_QUALITY, FACE_IMAGE_QUALITY])
+    return img_encoded.tobytes()
+
+def _store_face_image(face_img):
+    """Encode a face image and return (image column value, image file)
+    
+    When images are stored as files the column holds the image path relative
+    to DB_DIR and image file is the (path, JPEG bytes) to write once the row
+    is committed; otherwise the column holds the JPEG bytes and image file is None.
+    """
+    img_bytes = _encode_jpeg(face_img)
+    if not STORE_FACE_IMAGES_AS_FILES:
+        return img_bytes, None
+    
+    file_path = os.path.join(FACE_IMAGES_DIR, f"{uuid.uuid4().hex}.jpg")
+    return os.path.relpath(file_path, DB_DIR), (file_path, img_bytes)
+
+def _write_face_image(file_path, img_bytes):
+    """Write a face image file for a committed row"""
+    with open(file_path, 'wb') as f:
+        f.write(img_bytes)
+
+def _remove_face_images():
+    """Remove every stored face image file"""
+    for file_name in os.listdir(FACE_IMAGES_DIR):
+        if file_name.endswith('.jpg'):
+            os.remove(os.path.join(FACE_IMAGES_DIR, file_name))
+
+def _prepare_batch(face_imgs, features_list):
+    """Prepare the image and features columns of many faces at once
     
-    # Convert features to bytes if provided
-    features_bytes = features.tobytes() if features is not None else None
+    Images are encoded on a thread pool (cv2.imencode and TurboJPEG release
+    the GIL) and all features share one float32 allocation, passed to SQLite
+    as per-row memoryview slices. Returns (images, image_files, features_blobs).
+    """
+    with ThreadPoolExecutor(max_workers=BATCH_ENCODE_WORKERS) as executor:
+        images, image_files = zip(*executor.map(_store_face_image, face_imgs))
     
-    # Get timestamp
-    timestamp = datetime.now().isoformat()
+    features_blobs = [None] * len(features_list)
+    present = [i for i, features in enumerate(features_list) if features is not None]
+    if present:
+        features_array = np.asarray([features_list[i] for i in present], dtype=np.float32).reshape(len(present), -1)
+        view = memoryview(features_array).cast('B')
+        stride = features_array.shape[1] * features_array.itemsize
+        for row, i in enumerate(present):
+            features_blobs[i] = sqlite3.Binary(view[row * stride:(row + 1) * stride])
     
-    return img_bytes, features_bytes, timestamp
+    return images, image_files, features_blobs
+
+def _insert_faces(cursor, rows, image_files, return_ids):
+    """Write job: insert prepared face rows and return their ids
+    
+    Rows whose name already exists (or repeats within rows) are skipped and
+    report the existing id; only inserted rows get their image file written.
+    """
+    # Skip existing names up front; conflicting inserts would still use up AUTOINCREMENT ids
+    face_ids = {}
+    for name, _, _ in rows:
+        result = cursor.execute(_SQL_SELECT_FACE_ID, (name,)).fetchone()
+        if result is not None:
+            face_ids[name] = result[0]
+    
+    new_rows = []
+    for row, image_file in zip(rows, image_files):
+        if row[0] not in face_ids:
+            face_ids[row[0]] = None
+            new_rows.append(row)
+            if image_file is not None:
+                _writer.after_commit(_write_face_image, *image_file)
+    
+    if new_rows:
+        cursor.executemany(_SQL_INSERT_FACE_WITH_FEATURES, new_rows)
+        
+        # executemany() doesn't expose lastrowid or RETURNING rows, but
+        # AUTOINCREMENT ids are sequential within this transaction
+        cursor.execute("SELECT seq FROM sqlite_sequence WHERE name = 'faces'")
+        first_id = cursor.fetchone()[0] - len(new_rows) + 1
+        for offset, (name, _, _) in enumerate(new_rows):
+            face_ids[name] = first_id + offset
+    
+    if not return_ids:
+        return []
+    return [face_ids[name] for name, _, _ in rows]
+
+def _delete_faces(cursor):
+    """Write job: delete every face and, once committed, their image files"""
+    cursor.execute("DELETE FROM faces")
+    _writer.after_commit(_remove_face_images)
+    return True
+
+def _set_active_person(cursor, person_id):
+    """Write job: point the active_person row at person_id"""
+    cursor.execute(_SQL_UPDATE_ACTIVE, (person_id,))
+    return True
 
-def save_faces_batch(cursor, conn, faces_data):
+def save_faces_batch(cursor, conn, faces_data, return_ids=True):
     """Save multiple faces to the database in a single transaction"""
     try:
         if not faces_data:
@@ -96,98 +416,210 @@ def save_faces_batch(cursor, conn, faces_data):
         if DEBUG_MODE:
             print(f"Saving {len(faces_data)} faces in batch...")
         
-        face_ids = []
-        cursor.execute("BEGIN TRANSACTION")
+        # Images are encoded here so the writer thread only runs SQL
+        face_imgs, names, features_list = zip(*faces_data)
+        images, image_files, features_blobs = _prepare_batch(face_imgs, features_list)
+        rows = list(zip(names, images, features_blobs))
         
-        try:
-            for face_img, name, features in faces_data:
-                img_bytes, features_bytes, timestamp = _prepare_face_data(face_img, features)
-                
-                # Insert into database
-                cursor.execute(
-                    "INSERT INTO faces (name, image, features, timestamp) VALUES (?, ?, ?, ?)",
-                    (name, img_bytes, features_bytes, timestamp)
-                )
-                face_ids.append(cursor.lastrowid)
-            
-            conn.commit()
-            
-            if DEBUG_MODE:
-                print(f"✓ Successfully saved {len(faces_data)} faces")
-            return face_ids
-            
-        except Exception as e:
-            conn.rollback()
-            raise e
+        face_ids = _writer.submit(_insert_faces, rows, image_files, return_ids).result()
+        if face_ids is None:
+            return []
+        
+        if DEBUG_MODE:
+            print(f"✓ Successfully saved {len(faces_data)} faces")
+        return face_ids
             
     except Exception as e:
         print(f"Error in batch save: {e}")
         return []
 
-def save_face(cursor, conn, face_img, name, features=None, quality_score=None):
-    """Save a face to the database with optional features and quality score"""
-    try:
-        if DEBUG_MODE:
-            print(f"Saving face for '{name}'...")
+class _DatabaseWriter:
+    """Owns the only read-write connection and applies queued writes in order
+    
+    A single daemon thread drains a SimpleQueue of write jobs and commits
+    whatever has queued up, at most WRITE_QUEUE_BATCH_SIZE jobs, per
+    transaction as soon as the queue is empty. Readers use their own
+    query_only connections, so no two connections compete for the write lock.
+    """
+    
+    def __init__(self):
+        self.conn = _connect()
+        self._queue = queue.SimpleQueue()
+        self._face_embeddings = {}
+        self._job_actions = []
+        self._thread = threading.Thread(target=self._run, name="face-db-writer", daemon=True)
+        self._thread.start()
+    
+    def submit(self, job, *args):
+        """Queue job(cursor, *args) and return a Future for its result
         
-        cursor.execute("BEGIN TRANSACTION")
-        try:
-            # Check if face already exists
-            cursor.execute("SELECT id FROM faces WHERE name = ?", (name,))
-            result = cursor.fetchone()
-            
-            if result is None:
-                # New face - save image
-                img_bytes, _, timestamp = _prepare_face_data(face_img)
-                cursor.execute('INSERT INTO faces (name, image, timestamp) VALUES (?, ?, ?)',
-                          (name, img_bytes, timestamp))
-                face_id = cursor.lastrowid
-            else:
-                face_id = result[0]
-            
-            # Handle features and quality score if provided
-            if features is not None and quality_score is not None:
-                # Check how many embeddings this face already has
-                cursor.execute("SELECT COUNT(*) FROM face_embeddings WHERE face_id = ?", (face_id,))
-                embedding_count = cursor.fetchone()[0]
-                
-                if embedding_count < MAX_EMBEDDINGS_PER_PERSON:  # Only store up to N averaged embeddings per face
-                    # Save the averaged embedding
-                    embedding_bytes = features.tobytes()
-                    cursor.execute('''
-                    INSERT INTO face_embeddings (face_id, features, quality_score)
-                    VALUES (?, ?, ?)
-                    ''', (face_id, embedding_bytes, float(quality_score)))
-            
-            conn.commit()
+        The Future resolves to None if the job or its transaction failed.
+        """
+        future = Future()
+        self._queue.put((job, args, future))
+        return future
+    
+    def after_commit(self, action, *args):
+        """From inside a job, run action(*args) once the job's writes are committed
+        
+        Used for file changes, which must not outlive a rolled-back row.
+        """
+        self._job_actions.append((action, args))
+    
+    def stop(self):
+        """Commit queued writes, then stop the thread and close its connection"""
+        self._queue.put(None)
+        self._thread.join()
+    
+    def _run(self):
+        stopping = False
+        while not stopping:
+            item = self._queue.get()
+            if item is None:
+                break
             
-            if DEBUG_MODE:
-                print(f"✓ Saved face {face_id} as '{name}'")
-            return face_id
+            # Only writes already waiting share the batch, so a lone write commits at once
+            batch = [item]
+            while len(batch) < WRITE_QUEUE_BATCH_SIZE:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
             
+            self._write_batch(batch)
+        
+        self.conn.close()
+    
+    def _write_batch(self, batch):
+        """Run a batch of write jobs in one transaction and resolve their futures
+        
+        Each job runs in its own savepoint, so a failing job is rolled back
+        alone and only its future resolves to None.
+        """
+        cursor = self.conn.cursor()
+        # Face saves keep the matrices they wrote here instead of re-reading them
+        self._face_embeddings = {}
+        results = []
+        actions = []
+        try:
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                for job, args, _ in batch:
+                    self._job_actions = []
+                    cursor.execute("SAVEPOINT write_job")
+                    try:
+                        results.append(job(cursor, *args))
+                        cursor.execute("RELEASE write_job")
+                        actions.extend(self._job_actions)
+                    except Exception as e:
+                        cursor.execute("ROLLBACK TO write_job")
+                        cursor.execute("RELEASE write_job")
+                        print(f"Error writing to database: {e}")
+                        results.append(None)
+                self.conn.commit()
+            except Exception as e:
+                self.conn.rollback()
+                raise e
         except Exception as e:
-            conn.rollback()
-            raise e
+            print(f"Error writing to database: {e}")
+            results = [None] * len(batch)
+            actions = []
+        finally:
+            cursor.close()
+        
+        # File changes follow the committed rows, in job order
+        for action, args in actions:
+            try:
+                action(*args)
+            except Exception as e:
+                print(f"Error updating face image files: {e}")
+        
+        for (_, _, future), result in zip(batch, results):
+            future.set_result(result)
+    
+    def save_face(self, cursor, face_img, prepared_image, name, features, quality_score):
+        """Write job: find or insert a face and add its new embedding
+        
+        prepared_image is the (image, image_file) encoded by save_face, or None
+        if the face already existed when it was queued.
+        """
+        # Existing faces only need a read; even a skipped INSERT advances AUTOINCREMENT
+        result = cursor.execute(_SQL_SELECT_FACE_ID, (name,)).fetchone()
+        
+        if result is None:
+            # New face - save image (only encoded here if the face was cleared after being queued)
+            image, image_file = prepared_image or _store_face_image(face_img)
+            result = cursor.execute(_SQL_INSERT_FACE, (name, image)).fetchone()
+            if result is None:
+                result = cursor.execute(_SQL_SELECT_FACE_ID, (name,)).fetchone()
+            elif image_file is not None:
+                self.after_commit(_write_face_image, *image_file)
+        face_id = result[0]
+        
+        # Handle features and quality score if provided (low-quality embeddings are never stored)
+        if features is not None and quality_score is not None and float(quality_score) >= MIN_QUALITY_KEEP:
+            if face_id not in self._face_embeddings:
+                self._face_embeddings[face_id] = _read_face_embeddings(cursor, face_id)
+            embeddings, qualities = self._face_embeddings[face_id]
             
-    except Exception as e:
-        print(f"Error saving face: {e}")
-        return None
+            if qualities is None or len(qualities) < MAX_EMBEDDINGS_PER_PERSON:  # Only store up to N averaged embeddings per face
+                embeddings, qualities = _append_embedding(
+                    embeddings, qualities, _as_float32(features), float(quality_score))
+                cursor.execute(_SQL_UPDATE_EMBEDDINGS, (
+                    _as_blob(embeddings), _as_blob(qualities), embeddings.shape[1], len(qualities), face_id))
+                # Cached only once written, so a rolled-back job leaves no trace here
+                self._face_embeddings[face_id] = embeddings, qualities
+        
+        return face_id
+
+def close_database():
+    """Commit queued writes and close the writer and APSW connections"""
+    global _writer, _apsw_conn
+    if _writer is not None:
+        _writer.stop()
+        _writer = None
+    if _apsw_conn is not None:
+        _apsw_conn.close()
+        _apsw_conn = None
+
+def save_face(cursor, conn, face_img, name, features=None, quality_score=None):
+    """Queue a face save with optional features and quality score
+    
+    Returns a Future resolving to the face_id (None if the save failed).
+    """
+    if DEBUG_MODE:
+        print(f"Saving face for '{name}'...")
+    
+    # Encode images of new faces here so the writer thread only runs SQL;
+    # known faces (continuous learning) don't need one
+    prepared_image = None
+    if cursor.execute(_SQL_SELECT_FACE_ID, (name,)).fetchone() is None:
+        prepared_image = _store_face_image(face_img)
+    
+    # Without a prepared image the job may still need the crop; copy it so
+    # later drawing on the frame can't change what gets saved
+    crop = face_img.copy() if prepared_image is None else None
+    future = _writer.submit(_writer.save_face, crop, prepared_image, name, features, quality_score)
+    if DEBUG_MODE:
+        def report(done):
+            if done.result() is not None:
+                print(f"✓ Saved face {done.result()} as '{name}'")
+        future.add_done_callback(report)
+    return future
 
 def clear_database(cursor, conn):
     """Clear all faces from the database"""
     try:
-        cursor.execute("BEGIN TRANSACTION")
-        try:
-            # Clear face_embeddings first (due to foreign key constraint)
-            cursor.execute("DELETE FROM face_embeddings")
-            # Then clear faces
-            cursor.execute("DELETE FROM faces")
-            conn.commit()
-            print("Database cleared")
-            return True
-        except Exception as e:
-            conn.rollback()
-            raise e
+        # Queued saves are committed first, in submission order
+        if not _writer.submit(_delete_faces).result():
+            return False
+        
+        print("Database cleared")
+        return True
     except Exception as e:
         print(f"Error clearing database: {e}")
         return False
@@ -210,32 +642,204 @@ def get_all_faces(cursor):
         print(f"Error getting faces: {e}")
         return []
 
+def _read_embedding_matrix(cursor, allocate=None):
+    """Read the best embeddings per face into one (N, d) float32 matrix
+    
+    allocate(shape) may supply the float32 matrix to fill (e.g. a memmap);
+    under APSW the BLOBs are read straight into it. Returns (embeddings,
+    qualities, face_ranges) where face_ranges maps face_id to
+    [name, start, end] rows of the matrix.
+    """
+    # Count and rows must come from the same connection's snapshot
+    db = _apsw_conn if _apsw_conn is not None else cursor
+    
+    # Upper bound: each face keeps at most its best N embeddings
+    total = db.execute(_SQL_COUNT_LOADED_EMBEDDINGS, (MAX_EMBEDDINGS_PER_PERSON,)).fetchone()[0]
+    if total == 0:
+        return np.empty((0, 0), dtype=np.float32), np.empty(0, dtype=np.float32), {}
+    
+    params = {'max_k': MAX_EMBEDDINGS_PER_PERSON}
+    if _apsw_conn is not None:
+        # The embeddings BLOBs are read straight into the matrix
+        rows = _apsw_conn.execute(_SQL_LOAD_EMBEDDING_META, params)
+    else:
+        rows = cursor.execute(_SQL_LOAD_EMBEDDINGS, params)
+    
+    embeddings = None
+    qualities = np.empty(total, dtype=np.float32)
+    face_ranges = {}
+    count = 0
+    for face_id, name, feat_blob, quality_blob, dim in rows:
+        # Keep the leading rows at or above MIN_QUALITY_KEEP
+        face_qualities = np.frombuffer(quality_blob, dtype=np.float32)
+        k = int(np.count_nonzero(face_qualities >= MIN_QUALITY_KEEP))
+        if k == 0:
+            continue
+        
+        if embeddings is None:
+            if allocate is not None:
+                embeddings = allocate((total, dim))
+            else:
+                embeddings = np.empty((total, dim), dtype=np.float32)
+        elif dim != embeddings.shape[1]:
+            if DEBUG_MODE:
+                print(f"Skipping embeddings for face {face_id}: dimension {dim} != {embeddings.shape[1]}")
+            continue
+        
+        end = count + k
+        if _apsw_conn is not None:
+            _read_apsw_blob(face_id, embeddings[count:end])
+        else:
+            embeddings[count:end] = np.frombuffer(feat_blob, dtype=np.float32, count=k * dim).reshape(k, dim)
+        qualities[count:end] = face_qualities[:k]
+        face_ranges[face_id] = [name, count, end]
+        count = end
+    
+    if embeddings is None:
+        # No face kept an embedding at or above MIN_QUALITY_KEEP
+        return np.empty((0, 0), dtype=np.float32), np.empty(0, dtype=np.float32), {}
+    
+    return embeddings[:count], qualities[:count], face_ranges
+
+def _read_apsw_blob(face_id, out):
+    """Read the leading rows of a face's embeddings BLOB through APSW into out"""
+    with _apsw_conn.blobopen("main", "faces", "embeddings", face_id, False) as blob:
+        blob.readinto(out)
+    return out
+
+def _build_face_data(embeddings, qualities, face_ranges):
+    """Split the embedding matrix into per-face views"""
+    face_data = {}
+    for face_id, (name, start, end) in face_ranges.items():
+        face_data[face_id] = {
+            'name': name,
+            'embeddings': embeddings[start:end],
+            'qualities': qualities[start:end]
+        }
+    return face_data
+
+def _embedding_fingerprint(cursor):
+    """Identify the current embedding contents of the database
+    
+    Saves and clears always change a count or AUTOINCREMENT id, unlike
+    the database file's mtime, which in WAL mode only moves on checkpoints.
+    The database's instance id and the file's inode tell a recreated,
+    replaced or restored database apart from the one the cache was built from.
+    """
+    cursor.execute(_SQL_EMBEDDING_FINGERPRINT)
+    return np.array([*cursor.fetchone(), os.stat(DB_PATH).st_ino,
+                     MAX_EMBEDDINGS_PER_PERSON, MIN_QUALITY_KEEP], dtype=np.float64)
+
+def _load_embedding_cache(fingerprint):
+    """Map the on-disk embedding cache, or return None if it is missing or stale"""
+    try:
+        with np.load(EMBEDDING_INDEX_PATH) as index:
+            if not np.array_equal(index['fingerprint'], fingerprint):
+                return None
+            face_ids = index['face_ids']
+            names = index['names']
+            ranges = index['ranges']
+            qualities = index['qualities']
+            dim = int(index['dim'])
+        
+        # A current cache without embeddings
+        if len(qualities) == 0:
+            return {}
+        
+        embeddings = np.memmap(EMBEDDING_CACHE_PATH, dtype=np.float32, mode='r',
+                               shape=(len(qualities), dim))
+    except (OSError, KeyError, ValueError):
+        return None
+    
+    face_ranges = {
+        int(face_id): [str(name), int(start), int(end)]
+        for face_id, name, (start, end) in zip(face_ids, names, ranges)
+    }
+    return _build_face_data(embeddings, qualities, face_ranges)
+
+def sync_embedding_cache(cursor):
+    """Rebuild the memory-mapped embedding cache from the database
+    
+    Writes all loaded embeddings to EMBEDDING_CACHE_PATH as one raw (N, d)
+    float32 matrix, with face ranges, names and qualities in
+    EMBEDDING_INDEX_PATH, and returns face data backed by the new mapping.
+    """
+    # Write to temporary files and swap them in so readers never see a partial cache
+    cache_tmp = EMBEDDING_CACHE_PATH + '.tmp'
+    
+    def allocate_arena(shape):
+        return np.memmap(cache_tmp, dtype=np.float32, mode='w+', shape=shape)
+    
+    # Embeddings are read directly into the on-disk arena
+    fingerprint = _embedding_fingerprint(cursor)
+    embeddings, qualities, face_ranges = _read_embedding_matrix(cursor, allocate_arena)
+    if not face_ranges:
+        # Still stamp an empty cache with the fingerprint so it counts as current
+        open(cache_tmp, 'wb').close()
+        dim = 0
+    else:
+        embeddings.flush()
+        dim = embeddings.shape[1]
+        nbytes = embeddings.nbytes
+        del embeddings
+        # Drop rows reserved for embeddings pruned by MIN_QUALITY_KEEP
+        os.truncate(cache_tmp, nbytes)
+    
+    index_tmp = EMBEDDING_INDEX_PATH + '.tmp'
+    with open(index_tmp, 'wb') as f:
+        np.savez(
+            f,
+            fingerprint=fingerprint,
+            face_ids=np.array(list(face_ranges), dtype=np.int64),
+            names=np.array([name for name, _, _ in face_ranges.values()]),
+            ranges=np.array([(start, end) for _, start, end in face_ranges.values()], dtype=np.int64),
+            qualities=qualities,
+            dim=np.int64(dim)
+        )
+    
+    os.replace(cache_tmp, EMBEDDING_CACHE_PATH)
+    os.replace(index_tmp, EMBEDDING_INDEX_PATH)
+    
+    return _load_embedding_cache(fingerprint)
+
+@contextmanager
+def _read_snapshot(cursor):
+    """Keep every query in the block on one database state while the writer commits
+    
+    WAL readers see the snapshot taken by their transaction's first read.
+    """
+    cursor.execute("BEGIN")
+    try:
+        if _apsw_conn is not None:
+            # A savepoint pins the APSW connection's snapshot as well
+            with _apsw_conn:
+                yield
+        else:
+            yield
+    finally:
+        cursor.execute("COMMIT")
+
 def load_face_embeddings(cursor):
-    """Load all averaged face embeddings from database"""
+    """Load all averaged face embeddings from database
+    
+    Each face's 'embeddings' is a (k, d) float32 view into one shared matrix
+    and 'qualities' the matching (k,) view, ordered by quality descending.
+    With USE_EMBEDDING_CACHE the matrix is a read-only memory map that is
+    rebuilt only when the database has changed.
+    """
     try:
-        cursor.execute('''
-        SELECT f.id, f.name, fe.features, fe.quality_score
-        FROM faces f
-        JOIN face_embeddings fe ON f.id = fe.face_id
-        ORDER BY f.id, fe.quality_score DESC
-        ''')
-        rows = cursor.fetchall()
-        
-        face_data = {}
-        for face_id, name, feat_blob, quality in rows:
-            if feat_blob is not None:
-                if face_id not in face_data:
-                    face_data[face_id] = {
-                        'name': name,
-                        'embeddings': [],
-                        'qualities': []
-                    }
-                            # Only store up to N embeddings per face
-            if len(face_data[face_id]['embeddings']) < MAX_EMBEDDINGS_PER_PERSON:
-                    face_data[face_id]['embeddings'].append(np.frombuffer(feat_blob))
-                    face_data[face_id]['qualities'].append(quality)
-        
-        return face_data
+        with _read_snapshot(cursor):
+            if USE_EMBEDDING_CACHE:
+                # Reader threads share the cache files; one rebuilds them at a time
+                with _cache_lock:
+                    face_data = _load_embedding_cache(_embedding_fingerprint(cursor))
+                    if face_data is None:
+                        if DEBUG_MODE:
+                            print("Rebuilding embedding cache...")
+                        face_data = sync_embedding_cache(cursor)
+                return face_data
+            
+            return _build_face_data(*_read_embedding_matrix(cursor))
     except Exception as e:
         print(f"Error loading face embeddings: {e}")
         return {}
@@ -247,12 +851,8 @@ def update_active_person(cursor, person_id):
         if person_id is None:
             return True
             
-        cursor.execute("""
-            UPDATE active_person 
-            SET person_id = ?, last_seen = CURRENT_TIMESTAMP 
-            WHERE id = (SELECT id FROM active_person LIMIT 1)
-        """, (person_id,))
-        cursor.connection.commit()
+        # Queued without waiting; the writer commits it with the next batch
+        _writer.submit(_set_active_person, person_id)
         if DEBUG_MODE:
             print(f"Updated active person to ID: {person_id}")
         return True
@@ -263,13 +863,11 @@ def update_active_person(cursor, person_id):
 def get_active_person(cursor):
     """Get the currently active person from the database"""
     try:
-        cursor.execute("""
-            SELECT f.id, f.name, a.last_seen 
-            FROM active_person a 
-            LEFT JOIN faces f ON a.person_id = f.id 
-            LIMIT 1
-        """)
-        result = cursor.fetchone()
+        if _apsw_conn is not None:
+            result = _apsw_conn.execute(_SQL_GET_ACTIVE).fetchone()
+        else:
+            cursor.execute(_SQL_GET_ACTIVE)
+            result = cursor.fetchone()
         if result and result[0] is not None:
             person_id, name, last_seen = result
             return person_id, name, last_seen
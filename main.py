@@ -6,11 +6,11 @@ from config import (
     HIGH_CONFIDENCE_THRESHOLD, REGISTRATION_SIMILARITY_THRESHOLD,
     SIMILARITY_CHANGE_THRESHOLD, FPS_UPDATE_INTERVAL,
     REGISTRATION_COOLDOWN, ERROR_DISPLAY_DURATION,
-    MAX_EMBEDDINGS_PER_PERSON
+    MAX_EMBEDDINGS_PER_PERSON, MIN_QUALITY_KEEP
 )
 from database import (
     init_database, save_face, clear_database, get_all_faces,
-    load_face_embeddings, update_active_person
+    load_face_embeddings, update_active_person, close_database
 )
 from detector import (
     init_face_detector, calculate_face_features
@@ -18,7 +18,7 @@ from detector import (
 from tracker import FaceTracker
 from utils import (
     calculate_brightness, check_face_quality,
-    get_adaptive_threshold
+    get_adaptive_threshold, make_recognizer
 )
 from display import (
     draw_face_box, draw_status
@@ -27,6 +27,32 @@ from display import (
 # Cache for face features
 face_features_cache = {}
 
+# Similarity scorer specialized for RECOGNITION_THRESHOLD
+recognize_embeddings = make_recognizer(RECOGNITION_THRESHOLD)
+
+def cache_new_face(face_id, name, features, quality):
+    """Add a newly registered face to the cache with its first embedding"""
+    # save_face doesn't store embeddings below MIN_QUALITY_KEEP, so neither does the cache
+    if quality < MIN_QUALITY_KEEP:
+        return
+    face_features_cache[face_id] = {
+        'name': name,
+        'embeddings': np.asarray([features], dtype=np.float32),
+        'qualities': np.asarray([quality], dtype=np.float32)
+    }
+
+def cache_embedding(face_id, features, quality):
+    """Append an averaged embedding to a cached face's (k, d) embedding matrix
+    
+    Returns False if the embedding is below MIN_QUALITY_KEEP and was not stored.
+    """
+    if quality < MIN_QUALITY_KEEP:
+        return False
+    face_data = face_features_cache[face_id]
+    face_data['embeddings'] = np.vstack([face_data['embeddings'], np.asarray(features, dtype=np.float32)])
+    face_data['qualities'] = np.append(face_data['qualities'], np.float32(quality))
+    return True
+
 def match_face(cursor, avg_features):
     """Match averaged face features against stored averaged embeddings and handle continuous learning"""
     try:
@@ -41,30 +67,24 @@ def match_face(cursor, avg_features):
         matches = []
         all_similarities = []  # For debugging
         
+        # Normalize the query once for all stored embeddings
+        query = np.asarray(avg_features, dtype=np.float32).ravel()
+        query = query / np.linalg.norm(query)
+        
         # Compare with all stored averaged embeddings for each person
         for face_id, face_data in face_features_cache.items():
             name = face_data['name']
             stored_embeddings = face_data['embeddings']
             
-            # Calculate similarities with all stored averaged embeddings
-            similarities = []
-            for stored_embedding in stored_embeddings:
-                # Normalize both vectors before calculating similarity
-                norm_avg = avg_features / np.linalg.norm(avg_features)
-                norm_stored = stored_embedding / np.linalg.norm(stored_embedding)
-                similarity = np.dot(norm_avg, norm_stored)
-                similarities.append(similarity)
-            
-            # Get best similarity for this person
-            max_similarity = max(similarities)
-            matches_above_threshold = [s for s in similarities if s > RECOGNITION_THRESHOLD]
+            # Similarities above RECOGNITION_THRESHOLD and best similarity for this person
+            match_count, similarity_sum, max_similarity = recognize_embeddings(stored_embeddings, query)
             
-            if matches_above_threshold:
-                avg_similarity = sum(matches_above_threshold) / len(matches_above_threshold)
+            if match_count:
+                avg_similarity = similarity_sum / match_count
                 matches.append({
                     'face_id': face_id,
                     'name': name,
-                    'match_count': len(matches_above_threshold),
+                    'match_count': match_count,
                     'avg_similarity': avg_similarity,
                     'max_similarity': max_similarity,
                     'embedding_count': len(stored_embeddings),
@@ -368,10 +388,7 @@ def main():
                                                 
                                                 # Update cache with the new averaged embedding
                                                 if len(face_features_cache[face_id]['embeddings']) < MAX_EMBEDDINGS_PER_PERSON:
-                                                    face_features_cache[face_id]['embeddings'].append(avg_features)
-                                                    face_features_cache[face_id]['qualities'].append(avg_quality)
-                                                    
-                                                    if DEBUG_MODE:
+                                                    if cache_embedding(face_id, avg_features, avg_quality) and DEBUG_MODE:
                                                         print(f"✓ Added new averaged embedding for {name} ({embedding_count + 1}/{MAX_EMBEDDINGS_PER_PERSON})")
                                                         print(f"  Similarity: {similarity:.4f}")
                                                 
@@ -438,15 +455,11 @@ def main():
                                         
                                         # Save to database with averaged embedding
                                         avg_quality = np.mean(track_info['embedding_qualities'])
-                                        face_id = save_face(cursor, conn, face_img, auto_name, avg_features, avg_quality)
+                                        face_id = save_face(cursor, conn, face_img, auto_name, avg_features, avg_quality).result()
                                         
                                         if face_id is not None:
                                             # Update cache
-                                            face_features_cache[face_id] = {
-                                                'name': auto_name,
-                                                'embeddings': [avg_features],
-                                                'qualities': [avg_quality]
-                                            }
+                                            cache_new_face(face_id, auto_name, avg_features, avg_quality)
                                             
                                             # Update track info with face_id
                                             track_info['name'] = auto_name
@@ -510,8 +523,7 @@ def main():
                                 # Update cache
                                 face_id = track_info['face_id']
                                 if face_id in face_features_cache:
-                                    face_features_cache[face_id]['embeddings'].append(avg_features)
-                                    face_features_cache[face_id]['qualities'].append(avg_quality)
+                                    cache_embedding(face_id, avg_features, avg_quality)
                                 
                                 # Clear embeddings and increment counter
                                 track_info['recognition_embeddings'] = []
@@ -569,15 +581,11 @@ def main():
                         features = calculate_face_features(face_img)
                         
                         # Save to database
-                        face_id = save_face(cursor, conn, face_img, name, features)
+                        face_id = save_face(cursor, conn, face_img, name, features).result()
 
                         if face_id is not None:
                             # Update cache
-                            face_features_cache[face_id] = {
-                                'name': name,
-                                'embeddings': [features],
-                                'qualities': [1.0]  # Default quality score for manual registration
-                            }
+                            cache_new_face(face_id, name, features, 1.0)  # Default quality score for manual registration
                             
                             # Update active person after manual registration
                             if DEBUG_MODE:
@@ -608,6 +616,7 @@ def main():
     finally:
         cap.release()
         cv2.destroyAllWindows()
+        close_database()
         conn.close()
         print("Application terminated.")
 
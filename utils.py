@@ -7,6 +7,12 @@ from config import (
     MAX_EYE_ANGLE, MIN_EYE_RATIO, MAX_NOSE_OFFSET, MIN_VERTICAL_RATIO, MAX_VERTICAL_RATIO
 )
 
+# Numba (optional) compiles the per-embedding similarity loop
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
 def calculate_iou(box1, box2):
     """Calculate IoU between two bounding boxes"""
     # box format: (x1, y1, x2, y2)
@@ -143,6 +149,58 @@ def get_embedding_based_threshold(embedding_count):
     else:
         return MANY_EMBEDDINGS_THRESHOLD  # Can be more lenient with many embeddings
 
+def make_recognizer(threshold):
+    """
+    Build a similarity scorer specialized for a fixed recognition threshold.
+    recognize(embeddings, query) compares a unit-norm query with each row of a
+    (k, d) embedding matrix and returns (match_count, similarity_sum,
+    max_similarity) over the cosine similarities above threshold.
+    With numba installed the threshold is compiled in as a constant.
+    """
+    threshold = float(threshold)
+    
+    if njit is not None:
+        # Reassociation lets the dot products vectorize; NaN/inf handling is kept
+        # (and division follows numpy), so a zero-norm row's NaN similarity never matches
+        @njit(fastmath={'reassoc', 'contract'}, error_model='numpy')
+        def recognize(embeddings, query):
+            # Compiled code doesn't bounds-check query[j]
+            if embeddings.shape[1] != query.shape[0]:
+                raise ValueError("Stored embedding and query dimensions differ")
+            match_count = 0
+            similarity_sum = 0.0
+            max_similarity = -1.0
+            for i in range(embeddings.shape[0]):
+                dot = 0.0
+                norm = 0.0
+                for j in range(embeddings.shape[1]):
+                    dot += embeddings[i, j] * query[j]
+                    norm += embeddings[i, j] * embeddings[i, j]
+                similarity = dot / np.sqrt(norm)
+                if similarity > max_similarity:
+                    max_similarity = similarity
+                if similarity > threshold:
+                    match_count += 1
+                    similarity_sum += similarity
+            return match_count, similarity_sum, max_similarity
+        
+        # Compile now rather than on the first recognized frame, for both the
+        # writable matrices built in memory and the read-only cache mapping
+        embeddings = np.ones((1, 1), dtype=np.float32)
+        query = np.ones(1, dtype=np.float32)
+        recognize(embeddings, query)
+        embeddings.setflags(write=False)
+        recognize(embeddings, query)
+        return recognize
+    
+    def recognize(embeddings, query):
+        if embeddings.shape[1] != query.shape[0]:
+            raise ValueError("Stored embedding and query dimensions differ")
+        similarities = embeddings @ query / np.linalg.norm(embeddings, axis=1)
+        above = similarities[similarities > threshold]
+        return len(above), float(above.sum()), float(np.nanmax(similarities))
+    return recognize
+
 def get_quality_based_threshold(matches):
     """
     Adjust threshold based on the quality of matching embeddings: